@@ -1,12 +1,16 @@
 import os
+import asyncio
+import hashlib
+import ipaddress
 import json
 import logging
-import time
-from typing import Optional, Any, Dict, Tuple
+import random
+import socket
+import urllib.request
+from typing import Optional, Any, Dict, Tuple, Union
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import httpx
+import orjson
 from telegram import Update
 from telegram.constants import ChatAction
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
@@ -21,15 +25,61 @@ API_URL_DEFAULT = "http://localhost:8000/api/v1/executions"
 API_BASE_DEFAULT = API_URL_DEFAULT.rsplit("/executions", 1)[0]  
 
 
+def _strip_content_type(headers: Dict[str, str]) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() != "content-type"}
+
+def _with_json_content_type(headers: Dict[str, str]) -> Dict[str, str]:
+    """Headers for pre-encoded JSON POSTs; keeps a user-set Content-Type."""
+    if any(k.lower() == "content-type" for k in headers):
+        return headers
+    return {**headers, "Content-Type": "application/json"}
+
+
 RUNTIME: Dict[str, Any] = {
     "api_url": API_URL_DEFAULT,      
     "api_base": API_BASE_DEFAULT,      
     "headers": {"Content-Type": "application/json", "Accept": "application/json"},
     "max_user_msg_len": 2000,
-    "poll_interval": 1.0,              
+    "poll_interval": 0.1,              
+    "poll_max_interval": 2.0,
+    "poll_jitter": 0.2,
     "max_wait": 120.0,                 
-    "session": None,                 
+    "http_retries": 2,
+    "http_backoff": 0.3,
+    "share_identical_prompts": False,  # True: dedupe across users, not just per user
 }
+# Derived headers are cached; /setheaders refreshes them.
+RUNTIME["headers_no_ct"] = _strip_content_type(RUNTIME["headers"])
+RUNTIME["headers_post"] = _with_json_content_type(RUNTIME["headers"])
+
+# Keys probed (in order) for a text answer inside a dict final_result.
+_FINAL_KEYS: Tuple[str, ...] = ("result", "final", "text", "message", "output")
+
+# Execution statuses (lowercased) that end the poll loop.
+_TERMINAL = frozenset({"completed", "failed", "timeout", "timed_out", "cancelled"})
+
+# Small JSON requests shouldn't wait on Nagle; keep idle pooled sockets alive.
+_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+# Gateway-style statuses worth retrying a request on.
+_RETRY_STATUSES = frozenset({502, 503, 504})
+
+# Pre-encoded body for the default route; only goal and user_id vary.
+# Equivalent to {"goal":..., "user_id":..., "max_depth": 1,
+#                "config_overrides": {"observability": {"mlflow": {"enabled": False}}}}
+_BODY_TMPL = (
+    b'{"goal":%b,"user_id":%d,"max_depth":1,'
+    b'"config_overrides":{"observability":{"mlflow":{"enabled":false}}}}'
+)
+
+# In-flight default-route calls keyed by prompt hash; waiters share one execution.
+_INFLIGHT: Dict[bytes, "asyncio.Task[str]"] = {}
+
+# Shared async client, created in main() before polling starts.
+HTTP: Optional[httpx.AsyncClient] = None
 
 
 logging.basicConfig(
@@ -67,33 +117,29 @@ UX: Dict[str, str] = {
 }
 
 
-def build_session() -> requests.Session:
-    """requests.Session with small retries. Respects HTTP(S)_PROXY from env."""
-    session = requests.Session()
-    retry = Retry(
-        total=2,
-        connect=2,
-        read=2,
-        backoff_factor=0.3,
-        status_forcelist=(502, 503, 504),
-        allowed_methods=frozenset(["GET", "POST"]),
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=10)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-    return session
-
 def _headers_no_ct() -> Dict[str, str]:
-    """Return headers without Content-Type (for GETs)."""
-    return {k: v for k, v in RUNTIME["headers"].items() if k.lower() != "content-type"}
+    """Return headers without Content-Type (for GETs). Cached; refreshed by /setheaders."""
+    return RUNTIME["headers_no_ct"]
 
 def _json_compact(obj: Any, limit: int = 2000) -> str:
+    """Pretty JSON capped at ~limit bytes; slices the encoded bytes before decoding."""
     try:
-        s = json.dumps(obj, ensure_ascii=False, indent=2)
+        b = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
     except Exception:
         s = str(obj)
-    return s if len(s) <= limit else s[:limit] + " …"
+        return s if len(s) <= limit else s[:limit] + " …"
+    if len(b) <= limit:
+        return b.decode()
+    # "ignore" drops a multi-byte char cut in half at the boundary.
+    return b[:limit].decode("utf-8", "ignore") + " …"
+
+def _poll_delay(attempt: int) -> float:
+    """Exponential backoff with jitter between status polls."""
+    base = float(RUNTIME.get("poll_interval", 0.1))
+    cap = float(RUNTIME.get("poll_max_interval", 2.0))
+    jitter = float(RUNTIME.get("poll_jitter", 0.2))
+    # Clamp the exponent: past the cap growth is moot, and huge ints overflow float.
+    return min(cap, base * 2 ** min(attempt, 16)) * (1 + random.uniform(0, jitter))
 
 def _soft_trim_user_text(s: str) -> Tuple[str, Optional[str]]:
     limit = int(RUNTIME.get("max_user_msg_len", 2000))
@@ -101,23 +147,44 @@ def _soft_trim_user_text(s: str) -> Tuple[str, Optional[str]]:
         return s[:limit], UX["trim_warn"].format(n=limit)
     return s, None
 
-def post_json(body: Dict[str, Any], timeout: int = 30) -> requests.Response:
-    session: requests.Session = RUNTIME["session"]
-    return session.post(RUNTIME["api_url"], json=body, headers=RUNTIME["headers"], timeout=timeout)
+async def _request_with_retry(method: str, url: str, **kwargs: Any) -> httpx.Response:
+    """
+    Send a request, backing off exponentially (with jitter) on 502/503/504.
+    Connect failures are retried by the transport, not here.
+    """
+    retries = int(RUNTIME.get("http_retries", 2))
+    backoff = float(RUNTIME.get("http_backoff", 0.3))
+    for attempt in range(retries):
+        resp = await HTTP.request(method, url, **kwargs)
+        if resp.status_code not in _RETRY_STATUSES:
+            return resp
+        await asyncio.sleep(backoff * 2 ** attempt * (1 + random.uniform(0, 0.2)))
+    return await HTTP.request(method, url, **kwargs)
+
+async def post_json(body: Union[Dict[str, Any], bytes], timeout: int = 30) -> httpx.Response:
+    """POST a JSON body; already-encoded bytes are sent as-is."""
+    if isinstance(body, bytes):
+        return await _request_with_retry(
+            "POST", RUNTIME["api_url"], content=body, headers=RUNTIME["headers_post"], timeout=timeout
+        )
+    return await _request_with_retry("POST", RUNTIME["api_url"], json=body, headers=RUNTIME["headers"], timeout=timeout)
+
+def _json_body(r: httpx.Response) -> Dict[str, Any]:
+    """Parse a backend JSON body; a non-JSON body (e.g. a proxy error page) is a network error."""
+    try:
+        return orjson.loads(r.content)
+    except orjson.JSONDecodeError as e:
+        raise httpx.DecodingError(f"Invalid JSON from {r.url}: {e}", request=r.request) from e
 
-def _get_status(execution_id: str) -> Dict[str, Any]:
-    session: requests.Session = RUNTIME["session"]
-    url = f"{RUNTIME['api_base']}/executions/{execution_id}/status"
-    r = session.get(url, headers=_headers_no_ct(), timeout=10)
+async def _get_status(url: str) -> Dict[str, Any]:
+    r = await _request_with_retry("GET", url, headers=_headers_no_ct(), timeout=10)
     r.raise_for_status()
-    return r.json()
+    return _json_body(r)
 
-def _get_result(execution_id: str) -> Dict[str, Any]:
-    session: requests.Session = RUNTIME["session"]
-    url = f"{RUNTIME['api_base']}/executions/{execution_id}"
-    r = session.get(url, headers=_headers_no_ct(), timeout=15)
+async def _get_result(url: str) -> Dict[str, Any]:
+    r = await _request_with_retry("GET", url, headers=_headers_no_ct(), timeout=15)
     r.raise_for_status()
-    return r.json()
+    return _json_body(r)
 
 def _extract_final_text_from_payload(payload: Dict[str, Any]) -> Optional[str]:
     """
@@ -132,34 +199,62 @@ def _extract_final_text_from_payload(payload: Dict[str, Any]) -> Optional[str]:
         s = fr.strip()
         return s or None
     if isinstance(fr, dict):
-        for k in ("result", "final", "text", "message", "output"):
+        for k in _FINAL_KEYS:
             v = fr.get(k)
             if isinstance(v, str) and v.strip():
                 return v.strip()
         return _json_compact(fr)
     return None
 
-def handle_default_route(prompt: str, user_id: int) -> str:
+async def _wait_terminal(status_url: str, execution_id: str, seen: Dict[str, str]) -> None:
+    """Poll status until terminal. seen["status"] keeps the latest for timeout reports."""
+    attempt = 0
+    while True:
+        status_payload = await _get_status(status_url)
+        status = (status_payload.get("status") or "").lower()
+        if status != seen.get("status"):
+            logger.info("[BOT] %s status=%s", execution_id, status)
+            seen["status"] = status
+
+        if status in _TERMINAL:
+            return
+
+        await asyncio.sleep(_poll_delay(attempt))
+        attempt += 1
+
+async def handle_default_route(prompt: str, user_id: int) -> str:
+    """
+    Single-flight wrapper around _run_default_route: an identical prompt
+    already in flight (same user, or any user if share_identical_prompts)
+    awaits that execution's reply instead of starting a new one.
+    """
+    scope = "" if RUNTIME.get("share_identical_prompts") else str(user_id)
+    key = hashlib.blake2b(f"{scope}\0{prompt}".encode(), digest_size=16).digest()
+
+    task = _INFLIGHT.get(key)
+    if task is None:
+        # The execution runs as its own task so no single caller owns it.
+        task = asyncio.ensure_future(_run_default_route(prompt, user_id))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _t: _INFLIGHT.pop(key, None))
+    # shield: a cancelled caller must not cancel the shared execution.
+    return await asyncio.shield(task)
+
+async def _run_default_route(prompt: str, user_id: int) -> str:
     """
     Flow:
       1) POST /executions -> execution_id (202)
       2) Poll /executions/{id}/status until terminal
       3) GET /executions/{id} -> extract final text
     """
-    body = {
-        "goal": prompt,
-        "user_id": user_id,
-        "max_depth": 1,
-        "config_overrides": {"observability": {"mlflow": {"enabled": False}}},
-    }
-
     try:
-        resp = post_json(body, timeout=15)
+        body = _BODY_TMPL % (orjson.dumps(prompt), user_id)
+        resp = await post_json(body, timeout=15)
         if not (200 <= resp.status_code < 300):
             return UX["backend_err"].format(code=resp.status_code, body=(resp.text or "")[:2000])
 
         try:
-            j = resp.json()
+            j = orjson.loads(resp.content)
         except Exception:
             j = {}
 
@@ -167,29 +262,20 @@ def handle_default_route(prompt: str, user_id: int) -> str:
         if not execution_id:
             return UX["success_no_text"].format(body=f"(no execution_id)\n{_json_compact(j)}")
 
-        logger.info(f"[BOT] started execution_id={execution_id}")
+        logger.info("[BOT] started execution_id=%s", execution_id)
 
-        t0 = time.monotonic()
-        poll_every = float(RUNTIME.get("poll_interval", 1.0))
-        max_wait = float(RUNTIME.get("max_wait", 30.0))
-        terminal = {"completed", "failed", "timeout", "timed_out", "cancelled"}
-        last_status: Optional[str] = None
+        result_url = f"{RUNTIME['api_base']}/executions/{execution_id}"
+        status_url = f"{result_url}/status"
 
-        while True:
-            status_payload = _get_status(execution_id)
-            status = (status_payload.get("status") or "").lower()
-            if status != last_status:
-                logger.info(f"[BOT] {execution_id} status={status}")
-                last_status = status
-
-            if status in terminal:
-                break
-            if time.monotonic() - t0 > max_wait:
-                return f"⚠️ Backend timed out waiting for result (last status={status or 'unknown'})."
-
-            time.sleep(poll_every)
+        max_wait = float(RUNTIME.get("max_wait", 30.0))
+        seen: Dict[str, str] = {}
+        try:
+            await asyncio.wait_for(_wait_terminal(status_url, execution_id, seen), timeout=max_wait)
+        except asyncio.TimeoutError:
+            last = seen.get("status") or "unknown"
+            return f"⚠️ Backend timed out waiting for result (last status={last})."
 
-        result_payload = _get_result(execution_id)
+        result_payload = await _get_result(result_url)
         text = _extract_final_text_from_payload(result_payload)
         if text:
             return text
@@ -197,9 +283,9 @@ def handle_default_route(prompt: str, user_id: int) -> str:
         compact = _json_compact({k: result_payload.get(k) for k in ("status", "final_result")})
         return UX["success_no_text"].format(body=compact)
 
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         return UX["timeout"]
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return f"{UX['network_err']}\n\nDetails: {e}"
     except Exception as e:
         logger.exception("Unexpected error in default route")
@@ -240,16 +326,26 @@ async def setheaders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text(UX["setheaders_usage"])
         return
     try:
-        headers = json.loads(raw)
+        headers = orjson.loads(raw)
         if not isinstance(headers, dict):
             raise ValueError("Headers must be a JSON object.")
         RUNTIME["headers"] = headers
+        RUNTIME["headers_no_ct"] = _strip_content_type(headers)
+        RUNTIME["headers_post"] = _with_json_content_type(headers)
         await update.message.reply_text(
-            UX["setheaders_ok"].format(headers=json.dumps(headers, ensure_ascii=False, indent=2))
+            UX["setheaders_ok"].format(headers=orjson.dumps(headers, option=orjson.OPT_INDENT_2).decode())
         )
     except Exception:
         await update.message.reply_text(UX["setheaders_err"])
 
+async def _delayed_typing(chat: Any, delay: float = 1.0) -> None:
+    """Show 'typing…' only if the caller is still waiting after `delay` seconds."""
+    await asyncio.sleep(delay)
+    try:
+        await chat.send_action(ChatAction.TYPING)
+    except Exception:
+        pass
+
 async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     body_txt = update.message.text.partition(" ")[2].strip()
     if not body_txt:
@@ -257,12 +353,7 @@ async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     try:
-        await update.effective_chat.send_action(ChatAction.TYPING)
-    except Exception:
-        pass
-
-    try:
-        body = json.loads(body_txt)
+        body = orjson.loads(body_txt)
         if not isinstance(body, dict):
             raise ValueError("Top-level JSON must be an object.")
     except Exception as e:
@@ -270,11 +361,15 @@ async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     try:
-        resp = post_json(body)
+        typing = asyncio.create_task(_delayed_typing(update.effective_chat))
+        try:
+            resp = await post_json(body)
+        finally:
+            typing.cancel()
         status = resp.status_code
         text_body = resp.text or ""
         try:
-            j = resp.json()
+            j = orjson.loads(resp.content)
             pretty = _json_compact(j, limit=3500)
             msg = f"Status: {status}\n{pretty}"
         except ValueError:
@@ -284,9 +379,9 @@ async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if len(msg) > 3900:
             msg = msg[:3900] + " …"
         await update.message.reply_text(msg)
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         await update.message.reply_text(UX["timeout"])
-    except requests.exceptions.RequestException:
+    except httpx.HTTPError:
         await update.message.reply_text(UX["network_err"])
     except Exception as e:
         logger.exception("Unexpected error in /raw")
@@ -295,33 +390,118 @@ async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     url = f"{RUNTIME['api_base']}/health"
     try:
-        r = RUNTIME["session"].get(url, headers=_headers_no_ct(), timeout=5)
+        r = await _request_with_retry("GET", url, headers=_headers_no_ct(), timeout=5)
         await update.message.reply_text(UX["ping_ok"].format(url=url, code=r.status_code))
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         await update.message.reply_text(UX["timeout"])
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         await update.message.reply_text(UX["ping_err"].format(url=url, details=str(e)))
 
+async def _process(update: Update, msg: str, uid: int, warn: Optional[str] = None) -> None:
+    """Run the backend flow for one message and send the reply (background task)."""
+    typing = asyncio.create_task(_delayed_typing(update.effective_chat))
+    try:
+        reply = await handle_default_route(msg, uid)
+    finally:
+        typing.cancel()
+    final = (warn + "\n\n" + reply) if warn else reply
+    if len(final) > 4000:
+        final = final[:4000] + " …"
+    await update.message.reply_text(final)
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_msg_raw = (update.message.text or "").strip()
     user_msg, warn = _soft_trim_user_text(user_msg_raw)
     user_id = update.message.from_user.id
 
+    # Don't hold the update slot while the backend works.
+    context.application.create_task(_process(update, user_msg, user_id, warn), update=update)
+
+async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(UX["unknown_cmd"])
+
+
+def _parse_no_proxy(entry: str) -> Tuple[Optional[str], Optional[int], str, Any]:
+    """
+    One NO_PROXY entry -> (scheme, port, kind, value). kind is "net" for IPv4/IPv6
+    addresses and CIDR ranges, "sub" for ".example.com" (subdomains only) and
+    "dom" for "example.com" (the domain and its subdomains).
+    """
+    scheme = None
+    if "://" in entry:
+        scheme, entry = entry.split("://", 1)
+        entry = entry.rstrip("/")
+    port = None
+    if entry.startswith("["):
+        host, _, rest = entry[1:].partition("]")
+        if rest.startswith(":") and rest[1:].isdigit():
+            port = int(rest[1:])
+        entry = host
+    elif entry.count(":") == 1 and entry.rsplit(":", 1)[1].isdigit():
+        entry, port_s = entry.rsplit(":", 1)
+        port = int(port_s)
     try:
-        await update.effective_chat.send_action(ChatAction.TYPING)
-    except Exception:
+        return scheme, port, "net", ipaddress.ip_network(entry, strict=False)
+    except ValueError:
         pass
+    entry = entry.lower()
+    if entry.startswith("."):
+        return scheme, port, "sub", entry[1:]
+    return scheme, port, "dom", entry
 
-    reply = handle_default_route(user_msg, user_id)
-    if len(reply) > 4000:
-        reply = reply[:4000] + " …"
-
-    if warn:
-        await update.message.reply_text(warn)
-    await update.message.reply_text(reply)
+class _EnvProxyTransport(httpx.AsyncBaseTransport):
+    """
+    httpx ignores HTTP(S)_PROXY / ALL_PROXY / NO_PROXY once a custom transport is
+    passed, so route per request here instead. NO_PROXY is matched per request,
+    which also covers IPv6 and CIDR entries that httpx mount patterns can't express.
+    """
 
-async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(UX["unknown_cmd"])
+    def __init__(self, **transport_opts: Any) -> None:
+        self._direct = httpx.AsyncHTTPTransport(**transport_opts)
+        proxies = urllib.request.getproxies()
+        no_proxy = [h.strip() for h in proxies.get("no", "").split(",") if h.strip()]
+        self._proxies: Dict[str, httpx.AsyncHTTPTransport] = {}
+        if "*" not in no_proxy:
+            for scheme in ("http", "https", "all"):
+                url = proxies.get(scheme)
+                if url:
+                    url = url if "://" in url else f"http://{url}"
+                    self._proxies[scheme] = httpx.AsyncHTTPTransport(proxy=url, **transport_opts)
+        self._no_proxy = [_parse_no_proxy(h) for h in no_proxy]
+
+    def _bypass(self, url: httpx.URL) -> bool:
+        host = url.host.lower()
+        try:
+            ip: Any = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        port = url.port or (443 if url.scheme == "https" else 80)
+        for scheme, entry_port, kind, value in self._no_proxy:
+            if (scheme and scheme != url.scheme) or (entry_port and entry_port != port):
+                continue
+            if kind == "net":
+                if ip is not None and ip in value:
+                    return True
+            elif host.endswith("." + value) or (kind == "dom" and host == value):
+                return True
+        return False
+
+    def _transport_for(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        if not self._proxies or self._bypass(url):
+            return self._direct
+        return self._proxies.get(url.scheme) or self._proxies.get("all") or self._direct
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._transport_for(request.url).handle_async_request(request)
+
+    async def aclose(self) -> None:
+        for transport in (self._direct, *self._proxies.values()):
+            await transport.aclose()
+
+async def _close_http(app: Any) -> None:
+    """Close the shared backend client once polling has stopped."""
+    if HTTP is not None:
+        await HTTP.aclose()
 
 
 def main() -> None:
@@ -329,9 +509,18 @@ def main() -> None:
     if not token or token == "PUT_YOUR_TELEGRAM_BOT_TOKEN_HERE":
         raise RuntimeError("Please set TELEGRAM_BOT_TOKEN")
 
-    RUNTIME["session"] = build_session()
+    global HTTP
+    # http2 is negotiated via ALPN on https backends; plain http stays HTTP/1.1.
+    # retries= covers connection failures; 502/503/504 are retried in _request_with_retry.
+    transport_opts: Dict[str, Any] = dict(
+        http2=True,
+        retries=2,
+        socket_options=_SOCKET_OPTIONS,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=200, keepalive_expiry=60),
+    )
+    HTTP = httpx.AsyncClient(transport=_EnvProxyTransport(**transport_opts), timeout=httpx.Timeout(30.0))
 
-    app = ApplicationBuilder().token(token).build()
+    app = ApplicationBuilder().token(token).concurrent_updates(True).post_shutdown(_close_http).build()
 
 
     app.add_handler(CommandHandler("start", start))